@@ -8,20 +8,23 @@
 
 """Encode videos into a format appropriate for streaming to a Sega Genesis.
 
-Requires ffmpeg with PNG output support, and the Python library PIL.
+Requires ffmpeg with PNG output support, ffprobe, and the Python libraries PIL
+and NumPy.
 
 You can fit ~13.6s of audio+video in a 4MB ROM with 128kB left for the player.
 """
 
 import argparse
-import glob
+import collections
+import concurrent.futures
 import io
 import os
-import shutil
+import struct
 import subprocess
 import sys
 import tempfile
 
+import numpy as np
 from PIL import Image
 
 from rle_encoder import rle_compress
@@ -40,12 +43,29 @@ FILE_FORMAT = 3
 FULLSCREEN_TILES = (32, 28)
 THUMBNAIL_TILES = (16, 14)
 
+# Size in bytes of one fullscreen frame in Sega format: a 32-byte palette
+# followed by 32 bytes per tile.
+FULLSCREEN_FRAME_SIZE = 32 + (FULLSCREEN_TILES[0] * FULLSCREEN_TILES[1] * 32)
+
 # Maximum number of video index entries.
 SEGA_VIDEO_INDEX_MAX_ENTRIES = 36032
 
 # An index offset that indicates EOF.
 EOF_OFFSET = 0xffffffff
 
+# The signature at the start of every PNG file.
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Scenes up to this many frames are quantized in a single ffmpeg pass, which
+# holds the whole scene in memory (~170kB per frame) until its palette is
+# ready.  Longer scenes take two passes, with the palette stored in a file.
+SINGLE_PASS_MAX_FRAMES = 300
+
+# Crop detection samples this many windows of this many seconds each, spread
+# evenly through the input, rather than decoding the whole thing.
+CROP_SAMPLES = 20
+CROP_SAMPLE_LENGTH = 1
+
 # Compression constants.
 COMPRESSION_NONE = 0
 COMPRESSION_RLE = 1
@@ -64,6 +84,15 @@ def main(args):
     print('--generate-resource-file and --compressed are mutually exclusive!')
     sys.exit(1)
 
+  if args.jobs is not None and args.jobs < 1:
+    print('--jobs must be at least 1!')
+    sys.exit(1)
+
+  # Resolve the default once, for every thread pool.  cpu_count() may return
+  # None if the count can't be determined.
+  if args.jobs is None:
+    args.jobs = os.cpu_count() or 1
+
   with tempfile.TemporaryDirectory(prefix='encode_sega_video_') as tmp_dir:
     print('Converting {} to {} at {} fps and {} Hz{}.'.format(
         args.input, args.output, args.fps, args.sample_rate,
@@ -74,48 +103,51 @@ def main(args):
     fullcolor_dir = os.path.join(tmp_dir, 'fullcolor')
     os.mkdir(fullcolor_dir)
 
-    scenes_dir = os.path.join(tmp_dir, 'scenes')
-    os.mkdir(scenes_dir)
-
-    quantized_scenes_dir = os.path.join(tmp_dir, 'quantized-scenes')
-    os.mkdir(quantized_scenes_dir)
+    palette_dir = os.path.join(tmp_dir, 'palettes')
+    os.mkdir(palette_dir)
 
     quantized_dir = os.path.join(tmp_dir, 'quantized')
     os.mkdir(quantized_dir)
 
+    # All frames in Sega format, back to back.
+    frames_path = os.path.join(tmp_dir, 'frames.bin')
+
     thumb_dir = os.path.join(tmp_dir, 'thumb')
     os.mkdir(thumb_dir)
 
-    # Detect crop settings for the input video.
-    crop = detect_crop(args)
+    # Audio doesn't depend on anything we learn about the video, so extract it
+    # in the background, resampled to the target sample rate and resolution,
+    # while the video is processed.
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+      audio_future = executor.submit(extract_audio, args, tmp_dir)
 
-    # Extract individual frames, reduced to the output framerate, and audio,
-    # resampled to the target sample rate and resolution.
-    extract_frames_and_audio(args, crop, fullcolor_dir, tmp_dir)
+      # Detect crop settings for the input video.
+      crop = detect_crop(args)
 
-    # Determine where scene changes are, to optimize the quantization process
-    # and improve color quality.
-    scenes = detect_scene_changes(args, fullcolor_dir)
+      # Extract individual frames, reduced to the output framerate.  Scene
+      # changes are detected along the way, to optimize the quantization
+      # process and improve color quality.
+      scene_changes_path = os.path.join(tmp_dir, 'scene_changes.txt')
+      num_frames = extract_frames(args, crop, fullcolor_dir, scene_changes_path)
+      scenes = detect_scene_changes(num_frames, scene_changes_path)
 
-    # Organize each scene's frames into a folder.
-    construct_scenes(fullcolor_dir, scenes_dir, scenes)
+      # Raises any exception from audio extraction.
+      audio_future.result()
 
-    # Quantize each scene.
-    quantize_scenes(args, scenes_dir, quantized_scenes_dir, scenes)
-
-    # Turn those scenes into a single sequence of frames again.
-    recombine_scenes(quantized_scenes_dir, quantized_dir)
+    # Quantize each scene, encoding each frame into Sega-formatted tiles
+    # on-the-fly.  For debugging, the quantized frames are also kept.
+    quantize_scenes(args, fullcolor_dir, palette_dir, quantized_dir,
+                    frames_path, scenes)
 
     # Dump a debug file if requested.
     if args.debug_encoding:
       dump_debug_file(quantized_dir, tmp_dir, args)
 
     # Generate a thumbnail image.
-    generate_thumbnail(args, fullcolor_dir, thumb_dir)
+    generate_thumbnail(args, fullcolor_dir, num_frames, thumb_dir)
 
-    # Generate the final output file, encoding each frame into Sega-formatted
-    # tiles on-the-fly.
-    generate_final_output(args, quantized_dir, tmp_dir, thumb_dir)
+    # Generate the final output file.
+    generate_final_output(args, frames_path, tmp_dir, thumb_dir)
 
     if args.generate_resource_file:
       generate_resource_file(args)
@@ -127,10 +159,71 @@ def run(debug, **kwargs):
   return subprocess.run(stdin=subprocess.DEVNULL, **kwargs)
 
 
-def detect_crop(args, keyframes_only=True):
+def popen(debug, **kwargs):
+  if debug:
+    print('+ ' + ' '.join(kwargs['args']))
+  return subprocess.Popen(stdin=subprocess.DEVNULL, **kwargs)
+
+
+def probe_duration(args):
+  # Returns the duration of the input in seconds, or None if unknown.
+  ffprobe_args = [
+    'ffprobe',
+    # Make no noise, except on error.
+    '-v', 'error',
+    # Output only the duration, as a bare number.
+    '-show_entries', 'format=duration',
+    '-of', 'default=noprint_wrappers=1:nokey=1',
+    # Input.
+    args.input,
+  ]
+  try:
+    process = run(args.debug, capture_output=True, text=True,
+                  args=ffprobe_args)
+  except OSError:
+    # No usable ffprobe, so the caller falls back to keyframe crop detection.
+    return None
+
+  try:
+    return float(process.stdout.strip())
+  except ValueError:
+    return None
+
+
+def crop_sample_times(args):
+  # Returns evenly spaced times at which to sample the input for crop
+  # detection, or None if the input is too short for sampling to pay off.
+  start = args.start or 0
+  end = args.end
+  if end is None:
+    end = probe_duration(args)
+    if end is None:
+      return None
+
+  length = end - start
+  if length < CROP_SAMPLES * CROP_SAMPLE_LENGTH * 2:
+    return None
+
+  # Each sample is centered in its share of the input.
+  spacing = length / CROP_SAMPLES
+  offset = (spacing - CROP_SAMPLE_LENGTH) / 2
+  return [start + spacing * i + offset for i in range(CROP_SAMPLES)]
+
+
+def detect_crop(args, mode='sampled'):
   rounding = 8  # round to a multiple of 8 pixels, the Sega tile size
 
-  print('Detecting video crop settings...', '' if keyframes_only else '(all frames)')
+  sample_times = None
+  if mode == 'sampled':
+    sample_times = crop_sample_times(args)
+    if sample_times is None:
+      return detect_crop(args, mode='keyframes')
+
+  print('Detecting video crop settings...', {
+    'sampled': '(sampled)',
+    'keyframes': '',
+    'all': '(all frames)',
+  }[mode])
 
   ffmpeg_args = [
     'ffmpeg',
@@ -138,7 +231,23 @@ def detect_crop(args, keyframes_only=True):
 
   filters = []
 
-  if keyframes_only:
+  if mode == 'sampled':
+    # Decode a short window at each sample time.  Seeking on the input is
+    # fast, so we never decode the parts in between.  The windows are joined
+    # into one stream, so that cropdetect accumulates over all of them, just
+    # as it would over the whole video.
+    for sample_time in sample_times:
+      ffmpeg_args.extend([
+        '-ss', str(sample_time),
+        '-t', str(CROP_SAMPLE_LENGTH),
+        '-i', args.input,
+      ])
+
+    filters.append('{}concat=n={}:v=1:a=0'.format(
+        ''.join('[{}:v]'.format(i) for i in range(len(sample_times))),
+        len(sample_times)))
+
+  if mode == 'keyframes':
     # Keyframes only.  As much as a 4x speedup on some of my content.
     # Saves ~3 minutes on a full movie.
     ffmpeg_args.extend([
@@ -151,40 +260,53 @@ def detect_crop(args, keyframes_only=True):
   # Cropdetect is the last filter.
   filters.append('cropdetect=round={}'.format(rounding))
 
-  ffmpeg_args.extend([
-    # Input.
-    '-i', args.input,
-    # No audio or sub or metadata processing.
-    '-an', '-sn', '-dn',
-    # Video filters.
-    '-vf', ','.join(filters),
-  ])
+  if mode == 'sampled':
+    ffmpeg_args.extend([
+      # No audio or sub or metadata processing.
+      '-an', '-sn', '-dn',
+      # Video filters, across all the sample inputs.
+      '-filter_complex', ','.join(filters),
+    ])
+  else:
+    ffmpeg_args.extend([
+      # Input.
+      '-i', args.input,
+      # No audio or sub or metadata processing.
+      '-an', '-sn', '-dn',
+      # Video filters.
+      '-vf', ','.join(filters),
+    ])
 
-  # Maybe subset the input.
-  if args.start:
-    ffmpeg_args.extend(['-ss', str(args.start)])
-  if args.end:
-    ffmpeg_args.extend(['-to', str(args.end)])
+    # Maybe subset the input.
+    if args.start:
+      ffmpeg_args.extend(['-ss', str(args.start)])
+    if args.end:
+      ffmpeg_args.extend(['-to', str(args.end)])
 
   ffmpeg_args.extend([
     # No output.
     '-f', 'null', '-',
   ])
 
-  process = run(args.debug,
-      check=True, capture_output=True, text=True, args=ffmpeg_args)
+  # If sampling fails for any reason, we fall back to a slower mode below.
+  process = run(args.debug, check=(mode != 'sampled'),
+      capture_output=True, text=True, args=ffmpeg_args)
 
   crop = None
-  for line in process.stderr.split('\n'):
-    if 'crop=' in line:
-      crop = line.split('crop=')[1].split(' ')[0]
-      # Do not break.  We get many of these lines, and take from the last.
+  if process.returncode == 0:
+    for line in process.stderr.split('\n'):
+      if 'crop=' in line:
+        crop = line.split('crop=')[1].split(' ')[0]
+        # Do not break.  We get many of these lines, and take from the last.
 
   if crop is None:
-    # We can try again without skipping keyframes.  For some very small videos,
-    # this is necessary.
-    if keyframes_only:
-      return detect_crop(args, keyframes_only=False)
+    # We can try again with more of the video.  Sampling can miss the content
+    # entirely, and for some very small videos, even skipping non-keyframes is
+    # too much.
+    if mode == 'sampled':
+      return detect_crop(args, mode='keyframes')
+    if mode == 'keyframes':
+      return detect_crop(args, mode='all')
 
     raise RuntimeError(
         'Unable to detect crop settings for {}'.format(args.input))
@@ -193,7 +315,19 @@ def detect_crop(args, keyframes_only=True):
   return crop
 
 
-def extract_frames_and_audio(args, crop, frame_dir, audio_dir):
+def escape_filter_value(value):
+  # Escape a string, such as a path, for use as a filter option value inside
+  # a filtergraph.  There are two levels: one for the filter's option list,
+  # and one for the filtergraph description around it.  See
+  # https://ffmpeg.org/ffmpeg-filters.html#Notes-on-filtergraph-escaping
+  for special in '\\\':':
+    value = value.replace(special, '\\' + special)
+  for special in '\\\'[],;':
+    value = value.replace(special, '\\' + special)
+  return value
+
+
+def extract_frames(args, crop, frame_dir, scene_changes_path):
   # Notes on frame sizing:
   #  - SD analog display (NTSC) is 320x240.
   #  - The player sets the Genesis video processor's (VDP) resolution to
@@ -202,8 +336,26 @@ def extract_frames_and_audio(args, crop, frame_dir, audio_dir):
   #    will look right on screen later.
   #  - The VDP works in 8x8 tiles, so 256x224 pixels is 32x28 tiles.
 
+  # Maybe subset the video output.  This is done in the filters rather than
+  # on the output, so that scene detection below sees only the frames we keep.
+  # It comes first, so that fps= below restores a known frame rate after the
+  # timestamps are reset.  Otherwise the muxer would assume 25 fps and
+  # duplicate frames.
+  filters = []
+  trim_options = []
+  if args.start:
+    trim_options.append('start={}'.format(args.start))
+  if args.end:
+    trim_options.append('end={}'.format(args.end))
+  if trim_options:
+    filters.append('trim={}'.format(':'.join(trim_options)))
+    # Unlike -ss on the output, trim keeps the original timestamps.  Without
+    # resetting them, the muxer would fill the gap before the first kept frame
+    # by repeating it.
+    filters.append('setpts=PTS-STARTPTS')
+
   # Array of ffmpeg filters to use.
-  filters = [
+  filters += [
     # Crop out blank parts of the input, if any.
     'crop={}'.format(crop),
     # Drop the framerate.
@@ -218,6 +370,21 @@ def extract_frames_and_audio(args, crop, frame_dir, audio_dir):
     'scale=256:224',
   ]
 
+  # Scene changes are detected in the same pass, on a copy of the final
+  # frames, so that the extracted frames don't have to be decoded again.
+  # Renumbering the copies makes each PTS a 0-based frame number.  The frames
+  # where a new scene starts are logged to a file, then discarded.
+  scene_filters = [
+    'setpts=N',
+    "select='gt(scene,{})'".format(args.scene_detection_threshold),
+    'metadata=mode=print:file={}'.format(
+        escape_filter_value(scene_changes_path)),
+    'nullsink',
+  ]
+
+  filter_graph = '[0:v]{},split[v][s];[s]{}'.format(
+      ','.join(filters), ','.join(scene_filters))
+
   ffmpeg_args = [
     'ffmpeg',
     # Make less noise.
@@ -227,25 +394,38 @@ def extract_frames_and_audio(args, crop, frame_dir, audio_dir):
     # Input.
     '-i', args.input,
     # Video filters.
-    '-vf', ','.join(filters),
+    '-filter_complex', filter_graph,
+    '-map', '[v]',
+    # Output specifier for frames.  These are uncompressed PPM files, which
+    # are larger than PNGs, but much cheaper to write and to read back.
+    '-pix_fmt', 'rgb24',
+    os.path.join(frame_dir, 'frame_%05d.ppm'),
   ]
 
-  # Maybe subset the video output.
-  if args.start:
-    ffmpeg_args.extend(['-ss', str(args.start)])
-  if args.end:
-    ffmpeg_args.extend(['-to', str(args.end)])
+  print('Extracting video frames...')
+  run(args.debug, check=True, args=ffmpeg_args)
 
-  ffmpeg_args.extend([
-    # Output specifier for frames.
-    os.path.join(frame_dir, 'frame_%05d.png')
-  ])
+  # Frames are numbered from 1 with no gaps, so the count is all anyone needs
+  # to find them later.
+  return sum(1 for entry in os.scandir(frame_dir)
+             if entry.name.endswith('.ppm'))
 
-  ffmpeg_args.extend([
+
+def extract_audio(args, audio_dir):
+  print('Extracting audio...')
+
+  ffmpeg_args = [
+    'ffmpeg',
+    # Make no noise, except on error.  Progress is shown for the video.
+    '-hide_banner', '-loglevel', 'error', '-nostats',
+    # Input.
+    '-i', args.input,
+    # No video or sub or metadata processing.
+    '-vn', '-sn', '-dn',
     # Encode as 8-bit signed raw PCM.
     '-c:a', 'pcm_s8',
     '-f', 's8',
-  ])
+  ]
 
   # Audio filters.
   audio_filters = [
@@ -275,7 +455,7 @@ def extract_frames_and_audio(args, crop, frame_dir, audio_dir):
     '-af', ','.join(audio_filters),
   ])
 
-  # Apply the same subset to the audio output.
+  # Maybe subset the audio output.
   if args.start:
     ffmpeg_args.extend(['-ss', str(args.start)])
   if args.end:
@@ -287,34 +467,19 @@ def extract_frames_and_audio(args, crop, frame_dir, audio_dir):
     temp_audio_file,
   ])
 
-  print('Extracting video frames and audio...')
   run(args.debug, check=True, args=ffmpeg_args)
 
 
-def detect_scene_changes(args, frame_dir):
-  print('Detecting scene changes...')
-
-  ffmpeg_args = [
-    'ffmpeg',
-    # Input PNGs treated as 1 fps so we can treat PTS as frame number.
-    '-r', '1',
-    # Input PNGs.
-    '-i', os.path.join(frame_dir, 'frame_%05d.png'),
-    # Video filters.
-    '-vf', "select='gt(scene,{})',showinfo".format(
-        args.scene_detection_threshold),
-    # No output.
-    '-f', 'null', '-',
-  ]
-
-  process = run(args.debug,
-      check=True, capture_output=True, text=True, args=ffmpeg_args)
-
+def detect_scene_changes(num_frames, scene_changes_path):
+  # Scene changes were logged during extraction.  Each PTS is the 0-based
+  # number of the frame where a new scene starts, which is the same as the
+  # 1-based number of the frame before it.
   scene_change_frames = []
-  for line in process.stderr.split('\n'):
-    if 'pts:' in line:
-      pts = int(line.split('pts:')[1].strip(' ').split(' ')[0])
-      scene_change_frames.append(pts)
+  with open(scene_changes_path, 'r') as f:
+    for line in f:
+      if 'pts:' in line:
+        pts = int(line.split('pts:')[1].strip(' ').split(' ')[0])
+        scene_change_frames.append(pts)
 
   # Each number in scene_changes is a frame number where a scene **ends**.
   scenes = []
@@ -323,41 +488,28 @@ def detect_scene_changes(args, frame_dir):
     scenes.append((start_frame, end_frame))
     start_frame = end_frame + 1
 
-  # The frame numbers are 1-based, so num_inputs is also the final frame number.
-  num_inputs = len(glob.glob(os.path.join(frame_dir, '*.png')))
-  scenes.append((start_frame, num_inputs))
+  # The frame numbers are 1-based, so num_frames is also the final frame number.
+  scenes.append((start_frame, num_frames))
 
   return scenes
 
 
-def construct_scenes(input_dir, output_dir, scenes):
-  scene_index = 0
-
-  for start_frame, end_frame in scenes:
-    scene_dir = os.path.join(output_dir, 'scene_{:05d}'.format(scene_index))
-    os.makedirs(scene_dir)
-
-    for input_num in range(start_frame, end_frame + 1):
-      # Maintain the same frame numbers when splitting.
-      frame_name = 'frame_{:05d}.png'.format(input_num)
-      input_frame = os.path.join(input_dir, frame_name)
-      output_frame = os.path.join(scene_dir, frame_name)
-      # This is a ton of data in full color frames, so don't make a copy, just
-      # hard link it.  For I/O bound stages, this is a huge speed-up.
-      os.link(input_frame, output_frame)
-
-    scene_index += 1
-    print('\rCreated {} / {} scenes...'.format(scene_index, len(scenes)),
-          end='')
-
-  print('')
+def quantize_scene(args, input_dir, output_pal_path, start_frame, num_frames,
+                   scale=None):
+  # Quantize the frames of a scene, yielding each of them in order as a
+  # paletted PNG.  An optimized palette is created for the scene as a whole.
+  # For long scenes, the palette is written to output_pal_path in between.
+  # If scale is given, the frames are first scaled to that (w, h) size.
 
+  # The scene is a range of frames within the input folder.  Input starts at
+  # the scene's first frame, and we stop after its last one.  Every scene goes
+  # through the same ffmpeg pipeline without copying its frames anywhere.
+  filters = [
+    'trim=end_frame={}'.format(num_frames),
+  ]
 
-def quantize_scene(args, input_scene_dir, output_scene_dir, start_frame):
-  # Create an optimized palette first.
-  output_pal_path = os.path.join(output_scene_dir, 'pal.png')
-
-  filters = []
+  if scale:
+    filters.append('scale={}:{}'.format(*scale))
 
   # If requested, apply gamma and contrast correction for washed out content.
   if args.gamma_correction:
@@ -395,73 +547,155 @@ def quantize_scene(args, input_scene_dir, output_scene_dir, start_frame):
   # Use the generated palette.
   paletteuse_filter = 'paletteuse=dither={}'.format(args.dithering)
 
-  ffmpeg_args = [
-    'ffmpeg',
-    # Make no noise, except on error.
-    '-hide_banner', '-loglevel', 'error', '-nostats',
+  input_args = [
     # Input and starting frame number.
     '-start_number', str(start_frame),
-    '-i', os.path.join(input_scene_dir, 'frame_%05d.png'),
-    # Quantize and generate a palette.
-    '-dst_range', '1',
-    '-vf', ','.join(filters + [palettegen_filter]),
-    # Output a palette image.
-    output_pal_path,
+    '-i', os.path.join(input_dir, 'frame_%05d.ppm'),
   ]
-  run(args.debug, check=True, args=ffmpeg_args)
 
-  ffmpeg_args = [
-    'ffmpeg',
-    # Make no noise, except on error.
-    '-hide_banner', '-loglevel', 'error', '-nostats',
-    # Input and starting frame number.
-    '-start_number', str(start_frame),
-    '-i', os.path.join(input_scene_dir, 'frame_%05d.png'),
-    # Palette.
-    '-i', output_pal_path,
-    # Quantize and then use the optimized palette on the frames in the scene.
-    '-filter_complex', ','.join(filters + [paletteuse_filter]),
-    # Output individual frames in PNG format with the same frame numbers.
-    '-start_number', str(start_frame),
-    os.path.join(output_scene_dir, 'frame_%05d.png'),
-  ]
-  run(args.debug, check=True, args=ffmpeg_args)
-
-
-def quantize_scenes(args, input_dir, output_dir, scenes):
-  scene_paths = sorted(glob.glob(os.path.join(input_dir, '*')))
-  scene_index = 0
-
-  while scene_index < len(scenes):
-    start_frame, end_frame = scenes[scene_index]
-    input_scene_dir = scene_paths[scene_index]
-    scene_name = os.path.basename(input_scene_dir)
-
-    output_scene_dir = os.path.join(output_dir, scene_name)
-    os.makedirs(output_scene_dir)
-
-    quantize_scene(args, input_scene_dir, output_scene_dir, start_frame)
-
-    scene_index += 1
-    print('\rQuantized {} / {} scenes...'.format(scene_index, len(scenes)),
-          end='')
-    if args.debug: print('')
+  if num_frames <= SINGLE_PASS_MAX_FRAMES:
+    # Generate the palette and use it in a single pass over the scene.  The
+    # quantized frames are split in two: one copy goes to palettegen, and the
+    # other is held by paletteuse until the palette is ready at the end of the
+    # scene.  This decodes and filters each frame only once, at the cost of
+    # keeping the scene's frames in memory.
+    filter_graph = '[0:v]{},split[a][b];[a]{}[p];[b][p]{}'.format(
+        ','.join(filters), palettegen_filter, paletteuse_filter)
+
+    ffmpeg_args = [
+      'ffmpeg',
+      # Make no noise, except on error.
+      '-hide_banner', '-loglevel', 'error', '-nostats',
+    ] + input_args + [
+      # Quantize, generate a palette, and use it on the frames in the scene.
+      '-dst_range', '1',
+      '-filter_complex', filter_graph,
+      # Stream individual frames back to us in PNG format.
+      '-f', 'image2pipe', '-c:v', 'png', 'pipe:1',
+    ]
+  else:
+    # The scene is too long to hold in memory, so generate the palette first,
+    # then use it in a second pass over the scene.
+    ffmpeg_args = [
+      'ffmpeg',
+      # Make no noise, except on error.
+      '-hide_banner', '-loglevel', 'error', '-nostats',
+    ] + input_args + [
+      # Quantize and generate a palette.
+      '-dst_range', '1',
+      '-vf', ','.join(filters + [palettegen_filter]),
+      # Output a palette image.
+      output_pal_path,
+    ]
+    run(args.debug, check=True, args=ffmpeg_args)
+
+    ffmpeg_args = [
+      'ffmpeg',
+      # Make no noise, except on error.
+      '-hide_banner', '-loglevel', 'error', '-nostats',
+    ] + input_args + [
+      # Palette.
+      '-i', output_pal_path,
+      # Quantize and then use the optimized palette on the frames in the scene.
+      '-filter_complex', ','.join(filters + [paletteuse_filter]),
+      # Stream individual frames back to us in PNG format.
+      '-f', 'image2pipe', '-c:v', 'png', 'pipe:1',
+    ]
+
+  with popen(args.debug, stdout=subprocess.PIPE, args=ffmpeg_args) as process:
+    yield from read_png_stream(process.stdout)
+
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, ffmpeg_args)
+
+
+def read_png_stream(stream):
+  # A PNG file is a signature followed by chunks, each of which is a 4-byte
+  # size, 4-byte type, data, and a 4-byte CRC.  The final chunk is always IEND,
+  # so this is how we split a stream of concatenated PNG files.
+  while True:
+    png = stream.read(len(PNG_SIGNATURE))
+    if not png:
+      return
+    assert png == PNG_SIGNATURE
+
+    chunk_type = None
+    while chunk_type != b'IEND':
+      chunk_header = stream.read(8)
+      if len(chunk_header) < 8:
+        raise RuntimeError('Truncated PNG stream from ffmpeg!')
+
+      chunk_size = int.from_bytes(chunk_header[0:4], 'big')
+      chunk_type = chunk_header[4:8]
+      png += chunk_header + stream.read(chunk_size + 4)
+
+    yield png
+
+
+def quantize_and_convert_scene(args, input_dir, palette_dir, debug_frame_dir,
+                               frames_path, start_frame, end_frame):
+  # Every frame is the same size in Sega format, so each scene writes to its
+  # own region of the frames file, no matter what order scenes finish in.
+  with open(frames_path, 'r+b') as frames_file:
+    frames_file.seek((start_frame - 1) * FULLSCREEN_FRAME_SIZE)
+
+    frame_num = start_frame
+    num_frames = end_frame - start_frame + 1
+    output_pal_path = os.path.join(
+        palette_dir, 'scene_{:05d}.png'.format(start_frame))
+    for png in quantize_scene(args, input_dir, output_pal_path,
+                              start_frame, num_frames):
+      frames_file.write(png_to_sega_frame(io.BytesIO(png), FULLSCREEN_TILES))
+
+      if args.debug_encoding:
+        debug_frame_name = 'frame_{:05d}.png'.format(frame_num)
+        with open(os.path.join(debug_frame_dir, debug_frame_name), 'wb') as f:
+          f.write(png)
+
+      frame_num += 1
+
+  # A short scene would leave a hole of blank frames in the file, or truncate
+  # it if this is the last scene.
+  if frame_num - start_frame != num_frames:
+    raise RuntimeError(
+        'Scene at frame {} quantized to {} frames instead of {}!'.format(
+            start_frame, frame_num - start_frame, num_frames))
+
+
+def quantize_scenes(args, input_dir, palette_dir, debug_frame_dir, frames_path,
+                    scenes):
+  # Start with an empty frames file, which each scene will write into.
+  open(frames_path, 'wb').close()
+
+  # Each scene is quantized by its own ffmpeg process, independent of the
+  # others, so keep one scene in flight per job (by default, per core).  The
+  # work happens in ffmpeg, so threads are enough to drive it.
+  with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+    futures = []
+    for start_frame, end_frame in scenes:
+      futures.append(executor.submit(quantize_and_convert_scene,
+          args, input_dir, palette_dir, debug_frame_dir, frames_path,
+          start_frame, end_frame))
+
+    num_quantized = 0
+    try:
+      for future in concurrent.futures.as_completed(futures):
+        # Raises any exception from the scene's ffmpeg process.
+        future.result()
+
+        num_quantized += 1
+        print('\rQuantized {} / {} scenes...'.format(
+            num_quantized, len(scenes)), end='')
+        if args.debug: print('')
+    except BaseException:
+      # On failure or Ctrl-C, don't start any more scenes.  Otherwise, leaving
+      # the executor waits for every queued scene to run to completion.
+      executor.shutdown(wait=False, cancel_futures=True)
+      raise
 
   if not args.debug: print('')
 
 
-def recombine_scenes(input_dir, output_dir):
-  # Since we maintained frame numbers during the split and quantization
-  # process, we simply combine the contents of all the input directories into
-  # the output directory.
-  scene_paths = glob.glob(os.path.join(input_dir, '*'))
-  for input_scene_dir in scene_paths:
-    for input_frame in glob.glob(os.path.join(input_scene_dir, '*.png')):
-      if input_frame.endswith('/pal.png'):
-        continue
-      shutil.move(input_frame, output_dir)
-
-
 def dump_debug_file(frame_dir, audio_dir, args):
   debug_output_path = args.output + '.debug'
   print('Generating debug output {}...'.format(debug_output_path))
@@ -493,9 +727,9 @@ def dump_debug_file(frame_dir, audio_dir, args):
   run(args.debug, check=True, args=ffmpeg_args)
 
 
-def png_to_sega_frame(in_path, out_file, expected_tiles):
-  img = Image.open(in_path)
-  pixels = img.getdata()
+def png_to_sega_frame(png_file, expected_tiles):
+  img = Image.open(png_file)
+  pixels = np.asarray(img, dtype=np.uint8)
   width, height = img.size
 
   # Entry 0 is always transparent when rendered.  We store black there.  If
@@ -505,14 +739,9 @@ def png_to_sega_frame(in_path, out_file, expected_tiles):
   # Convert the PNG palette into a Sega palette.  Only take the first 15
   # entries, though there will be 256 total.  Entry [15] and on will be equal
   # to entry [14], and will not be added to the Sega palette.
-  img_pal = img.getpalette()
-  for i in range(0, 15*3, 3):
-    r, g, b = img_pal[i:i+3]
-    c = rgb_to_sega_color(r, g, b)
-    palette.append(c)
-
-  # Each tile is 8x8 pixels, 4 bit palette index per pixel.
-  binary_tiles = b''
+  img_pal = np.array(img.getpalette()[0:15*3], dtype=np.uint8).reshape(15, 3)
+  colors = rgb_to_sega_color(img_pal[:, 0], img_pal[:, 1], img_pal[:, 2])
+  palette.extend(colors.tolist())
 
   # The image dimensions should each be a multiple of 8 already.
   assert width % 8 == 0 and height % 8 == 0
@@ -522,32 +751,24 @@ def png_to_sega_frame(in_path, out_file, expected_tiles):
   # We should have a fullscreen image.
   assert (tiles_width, tiles_height) == expected_tiles
 
-  for tile_y in range(tiles_height):
-    for tile_x in range(tiles_width):
-      tile = []
+  # PNG palette runs 0-14, but Sega 0 is transparent, so shift this to the
+  # range 1-15.
+  assert pixels.max() < 15
+  palette_indexes = pixels + 1
 
-      for y in range(8):
-        for x in range(8):
-          pixel_y = (tile_y * 8) + y
-          pixel_x = (tile_x * 8) + x
-          pixel_index = pixel_y * width + pixel_x
+  # Each tile is 8x8 pixels, 4 bit palette index per pixel.  Pack pixels while
+  # the image is still in contiguous rows.  A pair of pixels never straddles
+  # two tiles, so each tile row is now 4 bytes.
+  packed_rows = pack_pixels(palette_indexes)
 
-          # PNG palette runs 0-14, but Sega 0 is transparent, so shift this to
-          # the range 1-15.
-          palette_index = pixels[pixel_index] + 1
-          assert(palette_index < 16)
+  # Reorder the packed rows of the whole image into rows of each tile, with
+  # tiles in left-to-right, top-to-bottom order.
+  tiles = packed_rows.reshape(tiles_height, 8, tiles_width, 4)
+  binary_tiles = tiles.transpose(0, 2, 1, 3).tobytes()
 
-          tile.append(palette_index)
-
-      binary_tiles += pack_tile(tile)
-
-  # SegaVideoFrameHeader contains the palette only
-  out_file.write(pack_palette(palette))
-  # Actual tile data follows
-  out_file.write(binary_tiles)
-
-  # A palette is always 32 bytes
-  return 32 + len(binary_tiles)
+  # SegaVideoFrameHeader contains the palette only, and actual tile data
+  # follows.
+  return pack_palette(palette) + binary_tiles
 
 
 def sega_color_map(value):
@@ -570,38 +791,40 @@ def sega_color_map(value):
   return 7
 
 
+# The same map as a lookup table for every 8-bit value, so that we can convert
+# whole arrays of colors at once.
+SEGA_COLOR_LUT = np.array(
+    [sega_color_map(value) for value in range(256)], dtype=np.uint16)
+
+
 def rgb_to_sega_color(r, g, b):
-  # We only get 3 bits of accuracy for each for red, green, and blue.
-  r = sega_color_map(r)
-  g = sega_color_map(g)
-  b = sega_color_map(b)
+  # We only get 3 bits of accuracy for each for red, green, and blue.  These
+  # can be single values or arrays.
+  r = SEGA_COLOR_LUT[r]
+  g = SEGA_COLOR_LUT[g]
+  b = SEGA_COLOR_LUT[b]
   # These get put into 4-bit fields in memory, ABGR, in a u16.
   return (b << 9) | (g << 5) | (r << 1)
 
 
-def pack_tile(palette_indexes):
-  packed = b''
-  for i in range(32):
-    first, second = palette_indexes[2*i : 2*i + 2]
-    packed += ((first << 4) | second).to_bytes(1, 'big')
-  return packed
+def pack_pixels(palette_indexes):
+  # Two 4-bit palette indexes per byte, with the left pixel in the high bits.
+  # Pixels are paired along the last dimension of the array.
+  return (palette_indexes[..., 0::2] << 4) | palette_indexes[..., 1::2]
 
 
 def pack_palette(palette):
-  packed = b''
   assert(len(palette) <= 16)
-  for i in range(16):  # palette may be smaller...
-    c = palette[i] if i < len(palette) else 0
-    packed += c.to_bytes(2, 'big')
-  return packed
+  padded = palette + [0] * (16 - len(palette))  # palette may be smaller...
+  return struct.pack('>16H', *padded)
 
 
 def patch_at_offset(f, patch_offset, value, size):
   offset = f.tell()
   f.seek(patch_offset)
   if type(value) == list:
-    for item in value:
-      f.write(item.to_bytes(size, 'big'))
+    # Pack the whole list at once, as big-endian values of this size.
+    f.write(np.array(value, dtype='>u{}'.format(size)).tobytes())
   else:
     f.write(value.to_bytes(size, 'big'))
   f.seek(offset)
@@ -611,73 +834,67 @@ class ChunkWritingState(object):
   sound_file = None
   samples_per_chunk = 0
   frames_per_chunk = 0
-  frame_paths = []
+  frames_file = None
   chunk_size = 0
   num_chunks = 0
   sound_len = 0  # bytes left to write
   frame_count = 0  # frames left to write
-  frame_path_index = 0  # next index into frame_paths
 
 
-def write_chunk(f, state):
-  # Write SegaVideoChunkHeader
-  start_of_chunk = f.tell()
+def build_chunk(state, start_of_chunk):
+  # Returns the next chunk, as it will appear at offset start_of_chunk in the
+  # uncompressed stream.  The offset determines the alignment padding.
   chunk_sound_size = min(state.sound_len, state.samples_per_chunk)
-  f.write(chunk_sound_size.to_bytes(4, 'big'))
   chunk_frame_count = min(state.frame_count, state.frames_per_chunk)
-  f.write(chunk_frame_count.to_bytes(2, 'big'))
-  f.write(bytes(2))  # "unused1", formerly "finalChunk"
+  chunk_frame_data_len = chunk_frame_count * FULLSCREEN_FRAME_SIZE
 
-  current_offset = f.tell()
-  pre_padding_remainder = (current_offset + 4) % 256
+  # The sound data after the 12-byte header is aligned with pre-padding.
+  pre_padding_remainder = (start_of_chunk + 12) % 256
   pre_padding_bytes = 256 - pre_padding_remainder if pre_padding_remainder else 0
-  f.write(pre_padding_bytes.to_bytes(2, 'big'))
-
-  # We fill this in later.
-  post_padding_bytes = 0
-  post_padding_bytes_offset = f.tell()
-  f.write(post_padding_bytes.to_bytes(2, 'big'))
-
-  # Add pre-padding.
-  f.write(bytes(pre_padding_bytes))
-
-  # Write audio:
-  sound_data = state.sound_file.read(chunk_sound_size)
-  if len(sound_data) < chunk_sound_size:
-    # Padding up to sound alignment requirements
-    sound_data += bytes(chunk_sound_size - len(sound_data))
-    assert len(sound_data) == chunk_sound_size
-  f.write(sound_data)
-  state.sound_len -= chunk_sound_size
 
-  # Write frames:
-  chunk_frame_data_len = 0
-  for i in range(chunk_frame_count):
-    input_path = state.frame_paths[state.frame_path_index]
-    bytes_written = png_to_sega_frame(input_path, f, FULLSCREEN_TILES)
-    chunk_frame_data_len += bytes_written
-    state.frame_count -= 1
-    state.frame_path_index += 1
-
-  # Figure out the post-padding.
-  end_of_frames = f.tell()
+  # Frames are all the same size, so we already know where they will end, and
+  # can compute the post-padding before writing anything.
+  end_of_frames = (start_of_chunk + 12 + pre_padding_bytes +
+                   chunk_sound_size + chunk_frame_data_len)
   post_padding_remainder = end_of_frames % 256
   post_padding_bytes = 256 - post_padding_remainder if post_padding_remainder else 0
 
-  # Seek back to fill in the post-padding field.
-  patch_at_offset(f, post_padding_bytes_offset, post_padding_bytes, 2)
+  # Assemble the whole chunk in a buffer of the final size.  The buffer starts
+  # zeroed, so padding needs no extra work, and the sound and frame data are
+  # read directly into their places.
+  end_of_chunk = end_of_frames + post_padding_bytes
+  chunk = bytearray(end_of_chunk - start_of_chunk)
+  view = memoryview(chunk)
+
+  # SegaVideoChunkHeader.  The third field is "unused1", formerly
+  # "finalChunk".
+  struct.pack_into('>IHHHH', chunk, 0,
+      chunk_sound_size, chunk_frame_count, 0,
+      pre_padding_bytes, post_padding_bytes)
+
+  # Add audio after the pre-padding.  If the sound file runs short, the rest
+  # is left as zeros, up to sound alignment requirements.
+  sound_offset = 12 + pre_padding_bytes
+  state.sound_file.readinto(
+      view[sound_offset:sound_offset + chunk_sound_size])
+  state.sound_len -= chunk_sound_size
 
-  # Add post-padding.
-  f.write(bytes(post_padding_bytes))
+  # Add frames, already in Sega format.  Post-padding follows them.
+  frames_offset = sound_offset + chunk_sound_size
+  frames_read = state.frames_file.readinto(
+      view[frames_offset:frames_offset + chunk_frame_data_len])
+  assert frames_read == chunk_frame_data_len
+  state.frame_count -= chunk_frame_count
 
   # If this is the first chunk, record the size.
-  end_of_chunk = f.tell()
   if state.chunk_size == 0:
     state.chunk_size = end_of_chunk - start_of_chunk
 
   # Count chunks.
   state.num_chunks += 1
 
+  return chunk
+
 
 def compress(compression, uncompressed):
   if compression == COMPRESSION_NONE:
@@ -689,7 +906,52 @@ def compress(compression, uncompressed):
   raise RuntimeError('Unrecognized compression constant')
 
 
-def generate_final_output(args, frame_dir, sound_dir, thumb_dir):
+def write_compressed_chunks(args, f, state, compression, index):
+  # Each chunk is decompressed into a buffer of its own, so its padding is
+  # relative to the start of the chunk, not the file.  That means chunks can
+  # be built ahead and compressed in the background, while earlier ones are
+  # still being written.  Only a few chunks are kept in flight at once, to
+  # bound memory use.  They are written, and indexed, in order.
+  max_in_flight = args.jobs * 2
+  total_frames = state.frame_count
+  pending = collections.deque()
+
+  with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+    try:
+      while True:
+        more_chunks = state.sound_len and state.frame_count
+        if not more_chunks and not pending:
+          break
+
+        if more_chunks:
+          # Minus one here because we need the final entry for the total size.
+          if state.num_chunks >= SEGA_VIDEO_INDEX_MAX_ENTRIES - 1:
+            raise RuntimeError('Streaming index overflow!')
+
+          uncompressed = build_chunk(state, 0)
+          future = executor.submit(compress, compression, uncompressed)
+          pending.append((future, total_frames - state.frame_count))
+
+          # Keep building until enough chunks are in flight.
+          if len(pending) < max_in_flight:
+            continue
+
+        # Write the oldest chunk once it is compressed.
+        future, frames_output = pending.popleft()
+        chunk_index = state.num_chunks - len(pending) - 1
+        index[chunk_index] = f.tell()
+        f.write(future.result())
+
+        print('\rOutput {} / {} frames...'.format(
+            frames_output, total_frames), end='')
+    except BaseException:
+      # On failure or Ctrl-C, drop any chunks not yet compressed, rather than
+      # waiting for them all on the way out.
+      executor.shutdown(wait=False, cancel_futures=True)
+      raise
+
+
+def generate_final_output(args, frames_path, sound_dir, thumb_dir):
   print('Generating final output {}...'.format(args.output))
 
   sound_path = os.path.join(sound_dir, 'sound.pcm')
@@ -706,11 +968,10 @@ def generate_final_output(args, frame_dir, sound_dir, thumb_dir):
   state.samples_per_chunk = args.sample_rate * args.chunk_length
   state.frames_per_chunk = args.fps * args.chunk_length
 
-  # List all frames:
-  state.frame_paths = sorted(glob.glob(os.path.join(frame_dir, '*.png')))
-  state.frame_count = len(state.frame_paths)
-
-  state.frame_path_index = 0
+  # Count all frames:
+  frames_len = os.path.getsize(frames_path)
+  assert frames_len % FULLSCREEN_FRAME_SIZE == 0
+  state.frame_count = frames_len // FULLSCREEN_FRAME_SIZE
 
   # Index of compressed chunk offsets.
   index = [ EOF_OFFSET ] * SEGA_VIDEO_INDEX_MAX_ENTRIES
@@ -721,21 +982,19 @@ def generate_final_output(args, frame_dir, sound_dir, thumb_dir):
     os.makedirs(output_folder, exist_ok=True)
 
   with open(sound_path, 'rb') as sound_file:
-    with open(args.output, 'wb') as f:
+    with open(frames_path, 'rb') as frames_file, open(args.output, 'wb') as f:
       state.sound_file = sound_file
+      state.frames_file = frames_file
       state.chunk_size = 0
       state.num_chunks = 0
 
-      # Write SegaVideoHeader
-      f.write(FILE_MAGIC)
-      f.write(FILE_FORMAT.to_bytes(2, 'big'))
-      f.write(args.fps.to_bytes(2, 'big'))
-      f.write(args.sample_rate.to_bytes(2, 'big'))
-      f.write(state.frame_count.to_bytes(4, 'big'))
-      f.write(state.sound_len.to_bytes(4, 'big'))
+      # Write SegaVideoHeader.  The chunk size and count are still zero here,
+      # and get patched at the end.
+      f.write(struct.pack('>16sHHHII',
+          FILE_MAGIC, FILE_FORMAT, args.fps, args.sample_rate,
+          state.frame_count, state.sound_len))
       chunk_size_offset = f.tell()
-      f.write(state.chunk_size.to_bytes(4, 'big'))
-      f.write(state.num_chunks.to_bytes(4, 'big'))
+      f.write(struct.pack('>II', state.chunk_size, state.num_chunks))
 
       # Compute the title for the metadata, truncate/pad to 128 bytes including
       # terminator.
@@ -744,14 +1003,12 @@ def generate_final_output(args, frame_dir, sound_dir, thumb_dir):
       title = title.encode('utf-8')
       title = (title + bytes(128))[0:127] + b'\0'
       assert len(title) == 128
-      f.write(title)
-
-      f.write(bytes(128)) # relative URL, filled in for catalog later
 
       compression = COMPRESSION_RLE if args.compressed else COMPRESSION_NONE
-      f.write(compression.to_bytes(2, 'big'))
 
-      f.write(bytes(696)) # Padding/unused
+      # The title is followed by the relative URL (128 bytes, filled in for
+      # catalog later), the compression type, and padding/unused (696 bytes).
+      f.write(struct.pack('>128s128xH696x', title, compression))
 
       with open(os.path.join(thumb_dir, 'thumb.segaframe'), 'rb') as thumb:
         f.write(thumb.read())
@@ -760,29 +1017,17 @@ def generate_final_output(args, frame_dir, sound_dir, thumb_dir):
       if args.compressed:
         # Write SegaVideoIndex (empty for now, will rewrite later)
         video_index_offset = f.tell()
-        for offset in index:
-          f.write(offset.to_bytes(4, 'big'))
+        f.write(np.array(index, dtype='>u4').tobytes())
 
-      total_frames = state.frame_count
-      while state.sound_len and state.frame_count:
-        if args.compressed:
-          # Minus one here because we need the final entry for the total size.
-          if state.num_chunks >= SEGA_VIDEO_INDEX_MAX_ENTRIES - 1:
-            raise RuntimeError('Streaming index overflow!')
-          index[state.num_chunks] = f.tell()
-
-          f2 = io.BytesIO()
-          write_chunk(f2, state)
-          f2.seek(0)
-          uncompressed = f2.read()
-
-          compressed = compress(compression, uncompressed)
-          f.write(compressed)
-        else:
-          write_chunk(f, state)
+      if args.compressed:
+        write_compressed_chunks(args, f, state, compression, index)
+      else:
+        total_frames = state.frame_count
+        while state.sound_len and state.frame_count:
+          f.write(build_chunk(state, f.tell()))
 
-        print('\rOutput {} / {} frames...'.format(
-            total_frames - state.frame_count, total_frames), end='')
+          print('\rOutput {} / {} frames...'.format(
+              total_frames - state.frame_count, total_frames), end='')
 
       print('')
 
@@ -818,43 +1063,22 @@ def generate_resource_file(args):
         ' and use the pointer "{}".'.format(output_name, output_variable_name))
 
 
-def generate_thumbnail(args, fullcolor_dir, thumb_dir):
+def generate_thumbnail(args, fullcolor_dir, num_frames, thumb_dir):
   # Choose a thumbnail frame by fraction through the video.
-  fullcolor_frames = sorted(glob.glob(os.path.join(fullcolor_dir, '*.png')))
-  thumb_index = int(len(fullcolor_frames) * args.thumbnail_fraction)
-  fullcolor_thumb_frame = fullcolor_frames[thumb_index]
-
-  # Set up what quantize_scene expects for input and output.
-  thumb_in_dir = os.path.join(thumb_dir, 'in')
-  thumb_out_dir = os.path.join(thumb_dir, 'out')
-  os.mkdir(thumb_in_dir)
-  os.mkdir(thumb_out_dir)
-
-  thumb_in = os.path.join(thumb_in_dir, 'frame_00001.png')
-  thumb_out = os.path.join(thumb_out_dir, 'frame_00001.png')
-  sega_frame_out = os.path.join(thumb_dir, 'thumb.segaframe')
+  thumb_index = int(num_frames * args.thumbnail_fraction)
 
-  # Create a half-sized version of the frame to quantize and convert to a
-  # Sega-compatible format.
-  ffmpeg_args = [
-    'ffmpeg',
-    # Make no noise, except on error.
-    '-hide_banner', '-loglevel', 'error', '-nostats',
-    # Input.
-    '-i', fullcolor_thumb_frame,
-    # Scale.
-    '-vf', 'scale=128:112',
-    # Output.
-    thumb_in,
-  ]
-  run(args.debug, check=True, args=ffmpeg_args)
+  sega_frame_out = os.path.join(thumb_dir, 'thumb.segaframe')
 
-  # Now quantize this half-sized image.
-  quantize_scene(args, thumb_in_dir, thumb_out_dir, 1)
+  # Quantize a half-sized version of the frame, scaled in the same ffmpeg
+  # pass, straight from the full-color frames.
+  thumb_size = (THUMBNAIL_TILES[0] * 8, THUMBNAIL_TILES[1] * 8)
+  thumb_pal = os.path.join(thumb_dir, 'pal.png')
+  thumb_png, = quantize_scene(args, fullcolor_dir, thumb_pal,
+                              thumb_index + 1, 1, scale=thumb_size)
 
   # Then convert to Sega format.
   with open(sega_frame_out, 'wb') as f:
-    png_to_sega_frame(thumb_out, f, THUMBNAIL_TILES)
+    f.write(png_to_sega_frame(io.BytesIO(thumb_png), THUMBNAIL_TILES))
 
   print('Thumbnail generated from frame #{}.'.format(thumb_index + 1))
 
@@ -932,6 +1156,11 @@ if __name__ == '__main__':
   parser.add_argument('--gamma-correction',
       action='store_true',
       help='Apply gamma and contrast correction for washed out content.')
+  parser.add_argument('-j', '--jobs',
+      type=int,
+      default=None,
+      help='Number of scenes to quantize, or chunks to compress, in parallel.'
+           ' Defaults to the number of CPU cores.')
   parser.add_argument('--debug',
       action='store_true',
       help='Print all ffmpeg commands.')
@@ -11,14 +11,16 @@
 These are already committed to the repo under the player folder, so this does
 not need to be rerun per app."""
 
+import numpy as np
+
+
 def write_trivial_tilemap(path, pal_num, width, height):
-  with open(path, 'wb') as f:
-    # The tiles are placed left-to-right, top-to-bottom in a trivial order.
-    for i in range(width * height):
-      # Stripped down version of TILE_ATTR_FULL() macro without priority or
-      # flipping.  Assuming no deduplication of tiles.
-      map_value = (pal_num << 13) | i
-      f.write(map_value.to_bytes(2, 'big'))
+  # The tiles are placed left-to-right, top-to-bottom in a trivial order.
+  # Stripped down version of TILE_ATTR_FULL() macro without priority or
+  # flipping.  Assuming no deduplication of tiles.
+  map_values = (pal_num << 13) | np.arange(width * height, dtype=np.uint16)
+  # Written as big-endian 16-bit values.
+  map_values.astype('>u2').tofile(path)
 
 # A full screen of tiles at the player's resolution is 32x28 tiles.
 write_trivial_tilemap('trivial_tilemap_0.bin', 0, 32, 28)
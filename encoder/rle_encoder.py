@@ -16,7 +16,7 @@
 #   0x80: a single byte follows, repeat |size| times in the output
 
 
-import os
+import numpy as np
 
 
 # How many repeated bytes we need to make compression worth it.  Anything more
@@ -35,25 +35,21 @@ TYPE_LITERAL = 0x00
 TYPE_REPEAT = 0x80
 
 
-def _count_repeats(block, offset):
-  original_offset = offset
-  while offset < len(block) and block[offset] == block[original_offset]:
-    offset += 1
-  # Offset is now the number of repeats.
-  return offset - original_offset
+def _find_runs(block):
+  # Returns the offset and length of every run of identical bytes in block.
+  data = np.frombuffer(block, dtype=np.uint8)
+  # A run starts at 0 and everywhere a byte differs from the one before it.
+  starts = np.flatnonzero(data[1:] != data[:-1]) + 1
+  starts = np.concatenate(([0], starts))
+  lengths = np.diff(np.append(starts, len(data)))
+  return starts, lengths
 
 
 def rle_compress(block):
   # The compressed output.
-  output = b''
-
-  # A buffer of literals to be flushed later.
-  literals = b''
-
-  def flush_buffered_literals():
-    # Take these from the outer scope
-    nonlocal literals, output
+  output = bytearray()
 
+  def flush_literals(literals):
     offset = 0
     while offset < len(literals):
       # Don't output more at once than fits in this size field
@@ -62,39 +58,33 @@ def rle_compress(block):
       offset += literal_block_size
 
       control_byte = TYPE_LITERAL | literal_block_size
-      output += control_byte.to_bytes(1, 'big')
-      output += literal_block
-
-    literals = b''
+      output.append(control_byte)
+      output.extend(literal_block)
 
   def compress_repeats(data, count):
-    # Take these from the outer scope
-    nonlocal output
-
     while count:
       # Don't output more at once than fits in this size field
       repeat_count = min(count, MAX_SIZE_FIELD)
       count -= repeat_count
 
       control_byte = TYPE_REPEAT | repeat_count
-      output += control_byte.to_bytes(1, 'big')
-      output += data
+      output.append(control_byte)
+      output.append(data)
+
+  # Only runs long enough to be worth compressing break up the literals.
+  # Everything in between them is output as literal bytes.
+  starts, lengths = _find_runs(block)
+  repeated = lengths >= MIN_REPEAT_FOR_COMPRESSION
 
   i = 0
-  while i < len(block):
-    count = _count_repeats(block, i)
-    these_bytes = block[i:i+count]
-    i += count
-
-    if count < MIN_REPEAT_FOR_COMPRESSION:
-      # Buffer literals for later
-      literals += these_bytes
-    else:
-      # Flush buffered literals first
-      flush_buffered_literals()
-      # Compress repeated sequence
-      compress_repeats(these_bytes[0:1], count)
-
-  # Flush any remaining buffered literals
-  flush_buffered_literals()
-  return output
+  for start, count in zip(starts[repeated].tolist(),
+                          lengths[repeated].tolist()):
+    # Flush literals before this run first
+    flush_literals(block[i:start])
+    # Compress repeated sequence
+    compress_repeats(block[start], count)
+    i = start + count
+
+  # Flush any remaining literals
+  flush_literals(block[i:])
+  return bytes(output)
@@ -19,21 +19,21 @@ ROTATE_PACKAGES = {
 }
 
 # Packages we know don't need rotation.
-OKAY_PACKAGES = [
+OKAY_PACKAGES = {
   'C_0603_1608Metric',
   'C_1206_3216Metric',
   'Crystal_SMD_0603-2Pin_6.0x3.5mm',
   'L_0603_1608Metric',
   'R_0603_1608Metric',
   'TSOP-I-48_18.4x12mm_P0.5mm',
-]
+}
 
 # Packages JLCPCB doesn't have at all AFAICT.
-DONT_HAVE_PACKAGES = [
+DONT_HAVE_PACKAGES = {
   'CP_Radial_D5.0mm_P2.00mm',
   'PinHeader_2x26_P2.54mm_Vertical',
   'TO-220-3_Horizontal_TabDown',
-]
+}
 
 bom_in, bom_out, pos_in, pos_out = sys.argv[1:]
 
@@ -47,7 +47,7 @@ with open(pos_in, 'r', newline='') as f:
   pos_fields = reader.fieldnames
   pos_rows = [row for row in reader]
 
-skipped_names = []
+skipped_names = set()
 with open(bom_out, 'w', newline='') as f:
   writer = csv.DictWriter(f, fieldnames=bom_fields)
   writer.writeheader()
@@ -63,7 +63,7 @@ with open(bom_out, 'w', newline='') as f:
       writer.writerow(row)
     else:
       print('Skipping {}, no part number'.format(name))
-      skipped_names.extend(name.split(','))
+      skipped_names.update(name.split(','))
 
 with open(pos_out, 'w', newline='') as f:
   writer = csv.DictWriter(f, fieldnames=pos_fields)
@@ -81,9 +81,9 @@ with open(pos_out, 'w', newline='') as f:
     # Correct the rotation of certain items.
     if package in ROTATE_PACKAGES:
       print('Fixing rotation of {}, package {}'.format(name, package))
-      rotation += ROTATE_PACKAGES[package]
-      while rotation < 0: rotation += 360
-      while rotation >= 360: rotation -= 360
+      # Python's modulo is never negative for a positive divisor, so this
+      # keeps the angle in [0, 360).
+      rotation = (rotation + ROTATE_PACKAGES[package]) % 360
       row['Rotation'] = '{:.6f}'.format(rotation)
     elif package in OKAY_PACKAGES or package in DONT_HAVE_PACKAGES:
       pass
@@ -23,17 +23,16 @@ import urllib.parse
 def parse_video(path):
   print('Parsing', path)
 
+  # The whole header is copied into the catalog, including the thumbnail at
+  # the end, so all 8192 bytes are needed.  Only the relative_url field within
+  # it changes, so we read it into a buffer and patch that field in place.
+  header = bytearray(8192)
   with open(path, 'rb') as f:
-    header = f.read(8192)
-  assert len(header) == 8192
-
-  # The header parts before and after the relative_url field.
-  first_part = header[0:38]
-  title_bytes = header[38:(38+128)]
-  # relative_url goes here
-  last_part = header[(38+128+128):]
+    header_len = f.readinto(header)
+  assert header_len == 8192
 
   # The title field as a string.
+  title_bytes = header[38:(38+128)]
   title = title_bytes.rstrip(b'\x00').decode('utf-8')
 
   # Compute the relative URL.
@@ -50,9 +49,12 @@ def parse_video(path):
   relative_url = (relative_url + bytes(128))[0:127] + b'\0'
   assert len(relative_url) == 128
 
+  # The relative_url field follows the title.
+  header[(38+128):(38+128+128)] = relative_url
+
   return {
     'title': title,
-    'catalog_header': first_part + title_bytes + relative_url + last_part,
+    'catalog_header': bytes(header),
   }
 
 